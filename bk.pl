@@ -144,7 +144,20 @@ position(Pos) :-
 
 %%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%
 
-:- dynamic legal_move/3.
+:- dynamic position_moves/3.
+:- dynamic f/3.
+
+% contents and legal moves of every position are asserted once by metrics.py, and the position being
+% queried is kept in a global variable by suggestion/3
+legal_move(From, To, Pos) :-
+    b_getval(legal_moves, Pos-Moves),
+    member(move(From, To), Moves).
+
+% moves suggested by the asserted tactic f/3 in the position with the given id
+suggestion(Id, From, To) :-
+    position_moves(Id, Pos, Moves),
+    b_setval(legal_moves, Pos-Moves),
+    f(Pos, From, To).
 
 attacks(From,To,Pos) :-
     to_coords(From, FromX, FromY),
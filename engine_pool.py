@@ -0,0 +1,105 @@
+import collections
+import os
+import queue
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from typing import Callable, Iterable, Iterator, Optional, TypeVar, Union
+
+import chess.engine
+
+PathLike = Union[str, bytes, os.PathLike]
+T = TypeVar('T')
+R = TypeVar('R')
+
+class EnginePool:
+    "A fixed pool of single-threaded UCI engines which can be shared between worker threads"
+
+    def __init__(self, engine_path: PathLike, size: int=os.cpu_count() or 1, hash_mb: int=64):
+        self.engine_path = engine_path
+        self.hash_mb = hash_mb
+        self.size = size
+        self.engines = []
+        self.lock = threading.Lock() # guards self.engines, which borrowing threads open and discard engines in
+        self.idle = queue.Queue() # idle engines, or None for a slot whose engine terminated
+        try:
+            for _ in range(size):
+                self.idle.put(self._open_engine())
+        except Exception:
+            self.close()
+            raise
+
+    def _open_engine(self) -> chess.engine.SimpleEngine:
+        engine = chess.engine.SimpleEngine.popen_uci(self.engine_path)
+        try:
+            engine.configure({'Threads': 1, 'Hash': self.hash_mb})
+        except Exception:
+            engine.close()
+            raise
+        with self.lock:
+            self.engines.append(engine)
+        return engine
+
+    def _discard_engine(self, engine: chess.engine.SimpleEngine):
+        "Remove an engine which has terminated from the pool"
+        with self.lock:
+            if engine in self.engines: # unless the pool has been closed meanwhile
+                self.engines.remove(engine)
+        try:
+            engine.close()
+        except chess.engine.EngineError:
+            pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    @contextmanager
+    def engine(self):
+        "Borrow an idle engine from the pool, blocking until one is available. An engine which terminates while borrowed is replaced by a fresh one for the next borrower"
+        engine: Optional[chess.engine.SimpleEngine] = self.idle.get()
+        if engine is None: # the previous engine in this slot terminated
+            try:
+                engine = self._open_engine()
+            except Exception:
+                self.idle.put(None)
+                raise
+        try:
+            yield engine
+        except chess.engine.EngineTerminatedError:
+            self._discard_engine(engine)
+            engine = None
+            raise
+        finally:
+            self.idle.put(engine)
+
+    def analyse(self, board: chess.Board, limit: chess.engine.Limit, **kwargs):
+        "Drop-in replacement for `SimpleEngine.analyse` which runs on the next idle engine, retrying once if the engine terminates"
+        try:
+            with self.engine() as engine:
+                return engine.analyse(board, limit, **kwargs)
+        except chess.engine.EngineTerminatedError:
+            with self.engine() as engine:
+                return engine.analyse(board, limit, **kwargs)
+
+    def imap(self, func: Callable[[T], R], iterable: Iterable[T]) -> Iterator[R]:
+        "Like `ThreadPoolExecutor.map`, but only reads ahead of the results far enough to keep every engine busy"
+        with ThreadPoolExecutor(max_workers=self.size) as executor:
+            pending = collections.deque()
+            for item in iterable:
+                pending.append(executor.submit(func, item))
+                if len(pending) >= 2 * self.size:
+                    yield pending.popleft().result()
+            while pending:
+                yield pending.popleft().result()
+
+    def close(self):
+        with self.lock:
+            engines, self.engines = self.engines, []
+        for engine in engines:
+            try:
+                engine.close()
+            except chess.engine.EngineError:
+                pass
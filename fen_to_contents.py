@@ -3,22 +3,20 @@
 import sys
 import chess
 
-def fen_to_contents(fen: str) -> str:
-    "Convert a FEN position into a contents predicate"
-    board = chess.Board()
-    board.set_fen(fen)
-    piece_str_list = []
-    for square in chess.SQUARES:
-        piece = board.piece_at(square)
-        if piece:
-            color = 'white' if piece.color else 'black'
-            piece_name = chess.piece_name(piece.piece_type)
-            row = chess.square_rank(square) + 1
-            col = chess.square_file(square) + 1
-            piece_str_list.append(f'contents({color}, {piece_name}, {col}, {row})')
-    return f'[{", ".join(piece_str_list)}]'
+def fen_to_contents(board: chess.Board) -> str:
+    "Convert a position into a contents predicate"
+    white = board.occupied_co[chess.WHITE]
+    piece_type_at = board.piece_type_at
+    piece_names = chess.PIECE_NAMES
+    # only visit occupied squares, in the same a1..h8 order as chess.SQUARES; file and rank are the low
+    # and high three bits of the square
+    piece_str_list = [
+        f'contents({"white" if white & (1 << square) else "black"},{piece_names[piece_type_at(square)]},{(square & 7) + 1},{(square >> 3) + 1})'
+        for square in chess.scan_forward(board.occupied)
+    ]
+    return '[' + ','.join(piece_str_list) + ']' # no spaces, Prolog doesn't need them
 
 if __name__ == '__main__':
-    fen = sys.argv[1]
-    # fen = 'rnbqkbnr/pppppppp/8/8/8/8/PPPPPPPP/RNBQKBNR w KQkq - 0 1'
-    print(fen_to_contents(fen))
\ No newline at end of file
+    board = chess.Board(sys.argv[1])
+    # board = chess.Board('rnbqkbnr/pppppppp/8/8/8/8/PPPPPPPP/RNBQKBNR w KQkq - 0 1')
+    print(fen_to_contents(board))
\ No newline at end of file
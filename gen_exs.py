@@ -2,80 +2,126 @@ import argparse
 import csv
 import os
 import random
-from contextlib import contextmanager
-from typing import List, Optional, TextIO, Union
-import code
+import tempfile
+from typing import Iterator, List, Optional, TextIO, Tuple, Union
 
 Seed = Optional[Union[int, float, str, bytes, bytearray]]
 PathLike = Union[str, bytes, os.PathLike]
+Example = Tuple[str, str, int]
 
 import chess
 import chess.engine
 import chess.pgn
 
+from engine_pool import EnginePool
+from pgn_utils import BoardCollector
+
 LICHESS_2013 = os.path.join('data', 'lichess_db_standard_rated_2013-01.pgn')
 
 STOCKFISH = os.path.join('bin', 'stockfish_14_x64')
 MAIA_1100 = os.path.join(os.path.expanduser('~'), 'repos', 'lc0', 'build', 'release', 'lc0')
 
-@contextmanager
-def get_engine(engine_path: PathLike):
+def scan_game_offsets(handle: TextIO) -> List[int]:
+    "Find the offset of every game in a PGN file in a single pass over the headers"
+    offsets = []
+    offset = handle.tell()
+    while chess.pgn.read_headers(handle) is not None:
+        offsets.append(offset)
+        offset = handle.tell() # start of the next game
+    return offsets
+
+def game_offsets(pgn_path: PathLike) -> List[int]:
+    "Offsets of every game in a PGN file, cached in a <pgn>.offsets file next to it which is rescanned when the PGN file changes"
+    stat = os.stat(pgn_path)
+    version = f'{stat.st_size} {stat.st_mtime_ns}' # identifies the version of the PGN file the offsets are for
+    cache_path = f'{os.fsdecode(pgn_path)}.offsets'
     try:
-        engine = chess.engine.SimpleEngine.popen_uci(engine_path)
-        yield engine
-    except chess.engine.EngineError:
+        with open(cache_path) as cache:
+            cached_version, _, count = cache.readline().strip().rpartition(' ')
+            if cached_version == version:
+                offsets = [int(line) for line in cache]
+                if len(offsets) == int(count): # a truncated file is rescanned
+                    return offsets
+    except (OSError, ValueError):
         pass
-    finally:
-        engine.close()
+    with open(pgn_path) as handle:
+        offsets = scan_game_offsets(handle)
+    # write the whole file before moving it into place, so that an interrupted or concurrent run never
+    # leaves a partial list of offsets behind
+    tmp_path = None
+    try:
+        with tempfile.NamedTemporaryFile('w', dir=os.path.dirname(cache_path) or '.', suffix='.offsets.tmp', delete=False) as tmp:
+            tmp_path = tmp.name
+            tmp.write(f'{version} {len(offsets)}\n')
+            tmp.writelines(f'{offset}\n' for offset in offsets)
+        os.replace(tmp_path, cache_path)
+    except OSError: # e.g. a read-only data directory, just scan again next time
+        if tmp_path is not None and os.path.exists(tmp_path):
+            os.remove(tmp_path)
+    return offsets
 
-def sample_pgn(handle: TextIO, num_games: int=10, pos_per_game: int=10, seed: Seed=1) -> List[chess.Board]:
-    "Sample positions from games in a PGN file"
+def sample_games(handle: TextIO, num_games: int=10, pos_per_game: int=10, seed: Seed=1, offsets: Optional[List[int]]=None) -> Iterator[List[chess.Board]]:
+    "Lazily sample positions from games in a PGN file, yielding each game's positions in the order they were played"
     random.seed(seed)
-    result = []
+    if offsets is None:
+        offsets = scan_game_offsets(handle)
 
-    # obtain num_game offsets from list of games
-    offsets = []
-    # code.interact(local=locals())
-    while _ := chess.pgn.read_headers(handle) is not None:
-        offset = handle.tell()
-        offsets.append(offset)
-    sampled_offsets = random.sample(offsets, num_games)
+    # reservoir sample num_games game offsets
+    sampled_offsets = []
+    for num_seen, offset in enumerate(offsets):
+        if num_seen < num_games:
+            sampled_offsets.append(offset)
+        else:
+            idx = random.randrange(num_seen + 1)
+            if idx < num_games:
+                sampled_offsets[idx] = offset
+    sampled_offsets.sort() # only seek forwards through the file
 
     # obtain pos_per_game positions from sampled list of games
     for offset in sampled_offsets:
         handle.seek(offset)
-        game = chess.pgn.read_game(handle)
-        positions = []
-        node = game.next()
-        while not node.is_end():
-            board = node.board()
-            positions.append(board)
-            node = node.next()
-        sampled_positions = random.sample(positions, pos_per_game)
-        result.extend(sampled_positions)
-
-    return result
-
-def get_engine_moves(engine: chess.engine.SimpleEngine, position: chess.Board, pos_limit: int=3) -> List[chess.Move]:
-    "Get engine move recommendations for a given position"
-    analysis = engine.analyse(position, limit=chess.engine.Limit(depth=1), multipv=pos_limit)
-    top_n_moves = [(root['score'].relative, root['pv'][0]) for root in analysis][:pos_limit]
-    return top_n_moves
-
-def gen_exs(exs_pgn_path: PathLike, engine_path: PathLike, num_games: int=10, pos_per_game: int=10, neg_to_pos_ratio: int=3):
-    
-    with open(exs_pgn_path) as handle:
-        sample_positions = sample_pgn(handle, num_games=num_games, pos_per_game=pos_per_game)
-    
-    with get_engine(engine_path) as engine:
-        for position in sample_positions:
-            moves = get_engine_moves(engine, position, neg_to_pos_ratio + 1)
-            if not moves:
-                continue
-            _, top_move = moves[0]
-            yield {'fen': position.fen(), 'uci': top_move.uci(), 'label': 1}
-            for _, move in moves[1:]:
-                yield {'fen': position.fen(), 'uci': move.uci(), 'label': 0}
+        boards = chess.pgn.read_game(handle, Visitor=BoardCollector)
+        positions = boards[1:-1] # skip the start and final positions
+        sampled_plies = random.sample(range(len(positions)), pos_per_game)
+        yield [positions[ply] for ply in sorted(sampled_plies)]
+
+def sample_pgn(handle: TextIO, num_games: int=10, pos_per_game: int=10, seed: Seed=1) -> Iterator[chess.Board]:
+    "Lazily sample positions from games in a PGN file"
+    for positions in sample_games(handle, num_games=num_games, pos_per_game=pos_per_game, seed=seed):
+        yield from positions
+
+def get_top_move(engine: Union[chess.engine.SimpleEngine, EnginePool], position: chess.Board) -> Optional[chess.Move]:
+    "Get the engine's top move recommendation for a given position"
+    analysis = engine.analyse(position, limit=chess.engine.Limit(depth=1))
+    return analysis['pv'][0] if 'pv' in analysis else None
+
+def gen_exs(exs_pgn_path: PathLike, engine_path: PathLike, num_games: int=10, pos_per_game: int=10, neg_to_pos_ratio: int=3, workers: int=os.cpu_count(), seed: Seed=1) -> Iterator[List[Example]]:
+    "Generate a batch of (fen, uci, label) examples for each sampled position, with the engine's top move as the positive example and other legal moves as negatives"
+
+    # negatives are sampled separately from positions so that they do not depend on how far the pool reads ahead
+    rng = random.Random(seed)
+    with open(exs_pgn_path) as handle, EnginePool(engine_path, workers) as pool:
+        # the header scan over the whole file is only done once per version of the PGN file
+        sample_positions = sample_games(handle, num_games=num_games, pos_per_game=pos_per_game, seed=seed, offsets=game_offsets(exs_pgn_path))
+
+        def analyse_game(positions):
+            "Analyse the positions of one game in order on a single engine, so that its hash table carries over between them"
+            try:
+                with pool.engine() as engine:
+                    return [(position, get_top_move(engine, position)) for position in positions]
+            except chess.engine.EngineTerminatedError: # the pool has replaced the engine, retry the game once
+                with pool.engine() as engine:
+                    return [(position, get_top_move(engine, position)) for position in positions]
+
+        for game_analyses in pool.imap(analyse_game, sample_positions):
+            for position, top_move in game_analyses:
+                if top_move is None:
+                    continue
+                fen = position.fen()
+                other_moves = [move for move in position.legal_moves if move != top_move]
+                examples = [(fen, top_move.uci(), 1)]
+                examples.extend((fen, move.uci(), 0) for move in rng.sample(other_moves, min(neg_to_pos_ratio, len(other_moves))))
+                yield examples
 
 def main():
     parser = argparse.ArgumentParser(description='Generate tactic training examples and write them to a csv file')
@@ -85,15 +131,16 @@ def main():
     parser.add_argument('-n', '--num-games', dest='num_games', type=int, default=10, help='Number of games to use')
     parser.add_argument('-p', '--pos-per-game', dest='pos_per_game', type=int, default=10, help='Number of positions to use per game')
     parser.add_argument('-r', '--ratio', dest='neg_to_pos_ratio', type=int, default=3, help='Ratio of negative to positive examples to generate')
+    parser.add_argument('-w', '--workers', dest='workers', type=int, default=os.cpu_count(), help='Number of single-threaded engine processes to analyse positions with')
     args = parser.parse_args()
 
-    with open(args.example_file, 'w') as output:
+    with open(args.example_file, 'w', buffering=1 << 20, newline='') as output:
         field_names = ['fen', 'uci', 'label']
-        writer = csv.DictWriter(output, fieldnames=field_names)
+        writer = csv.writer(output)
 
-        writer.writeheader()
-        for ex in gen_exs(args.pgn_file, args.engine_path, args.num_games, args.pos_per_game, args.neg_to_pos_ratio):
-            writer.writerow(ex)
+        writer.writerow(field_names)
+        for exs in gen_exs(args.pgn_file, args.engine_path, args.num_games, args.pos_per_game, args.neg_to_pos_ratio, args.workers):
+            writer.writerows(exs)
 
 if __name__ == '__main__':
     main()
@@ -6,8 +6,14 @@ class Predicate:
     def __init__(self, name, num_args):
         self.name = name
         self.num_args = num_args
+        self.type_list = None
+        self.dir_list = None
+        self._str = self._build_str()
 
     def __str__(self):
+        return self._str
+
+    def _build_str(self):
         if self.type_list:
             types_str = f"{', '.join([type_name.capitalize() for type_name in self.type_list])}"
         else:
@@ -20,6 +26,7 @@ class Predicate:
     def set_type(self, type_list):
         assert len(type_list) == self.num_args, f'Pred: {self.name}, #Args = {self.num_args}, typeof(args): {type(self.num_args)}, type_list: {type_list}'
         self.type_list = type_list
+        self._str = self._build_str()
 
     def set_direction(self, dir_list):
         assert len(dir_list) == self.num_args, f'Pred: {self.name}, #Args = {self.num_args}, typeof(args): {type(self.num_args)}, dir_list: {dir_list}'
@@ -33,7 +40,8 @@ class TacticGrammar:
 
     def __init__(self, bias_filename: str):
         result = parse_file(bias_filename)
-        for fact in result:
+        for clause in result:
+            fact = clause[0]
             if fact.id == 'max_body':
                 self.max_body = fact.args[0]
             elif fact.id == 'max_vars':
@@ -64,17 +72,26 @@ class TacticGrammar:
                     predicate = Predicate(pred_name, len(dir_list))
                     self.pred_map[pred_name] = predicate
                 self.pred_map[pred_name].set_direction(dir_list)
+        # the grammar is fixed once the bias file has been read
+        self._str = self._build_str()
+        for predicate in self.body_preds:
+            predicate.arg_plan = list(zip(predicate.dir_list, predicate.type_list))
 
     def __str__(self):
-        pred_rules_str = '\n'.join([f'{pred_name.capitalize()} -> {str(pred)}' for pred_name, pred in self.pred_map.items() if pred_name != self.head_pred])
-        return f'''{self.head_pred.capitalize()} -> Predicate | ε
+        return self._str
+
+    def _build_str(self):
+        pred_rules_str = '\n'.join([f'{pred_name.capitalize()} -> {str(pred)}' for pred_name, pred in self.pred_map.items() if pred_name != self.head_pred.name])
+        return f'''{self.head_pred.name.capitalize()} -> Predicate | ε
 
-Predicate -> {' | '.join([pred_name.capitalize() for pred_name in self.pred_map.keys() if pred_name != self.head_pred])}
+Predicate -> {' | '.join([pred_name.capitalize() for pred_name in self.pred_map.keys() if pred_name != self.head_pred.name])}
 
 {pred_rules_str}'''
 
     def generate(self, n, seed=1):
         random.seed(seed)
+        choice = random.choice
+        rand = random.random
         choices = random.choices(self.body_preds, k=n) # TODO: hard-code choice of make_move
         # print(',\n'.join([str(choice) for choice in choices]))
 
@@ -86,27 +103,27 @@ Predicate -> {' | '.join([pred_name.capitalize() for pred_name in self.pred_map.
             'Piece': [],
             'Side': []
         }
+        type_counts = {_type: len(type_vars) for _type, type_vars in var_map.items()}
         grounding = {}
         for predicate in choices:
-            grounding[predicate.name] = [None] * predicate.num_args
-            for idx in range(predicate.num_args):
-                # print(str(predicate))
-                dir = predicate.dir_list[idx]
-                _type = predicate.type_list[idx]
+            args = grounding[predicate.name] = [None] * predicate.num_args
+            for idx, (dir, _type) in enumerate(predicate.arg_plan):
+                type_vars = var_map[_type]
                 if dir == 'in': # var must exist in var_map, else use '_'
-                    if var_map[_type]: # var of requisite type exists (list is non-empty)
-                        grounding[predicate.name][idx] = random.choice(var_map[_type]) # select a var at random
+                    if type_vars: # var of requisite type exists (list is non-empty)
+                        args[idx] = choice(type_vars) # select a var at random
                     else:
-                        grounding[predicate.name][idx] = '_'
+                        args[idx] = '_'
                 else: # var need not exist, could use existing one or create a new one
-                    use_existing = random.random() # 50/50 chance of using existing var or creating a new one
-                    if use_existing < 0.5 and var_map[_type]:
-                        grounding[predicate.name][idx] = random.choice(var_map[_type]) # select a var at random
+                    use_existing = rand() # 50/50 chance of using existing var or creating a new one
+                    if use_existing < 0.5 and type_vars:
+                        args[idx] = choice(type_vars) # select a var at random
                     else:
                         # create new var
-                        new_var = f'{_type}_{len(var_map[_type])}'
-                        var_map[_type].append(new_var)
-                        grounding[predicate.name][idx] = new_var
+                        new_var = f'{_type}_{type_counts[_type]}'
+                        type_counts[_type] += 1
+                        type_vars.append(new_var)
+                        args[idx] = new_var
         # print(choices, grounding)
         return choices, grounding
 
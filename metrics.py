@@ -1,19 +1,22 @@
+import functools
 import logging
-import math
+import multiprocessing
 import os
-import sys
+from concurrent.futures import ProcessPoolExecutor
 from parser import parse_file
-from typing import List
 import argparse
 
 import chess
 import chess.engine
 import chess.pgn
+import numpy as np
 from pyswip import Prolog
 from pyswip.prolog import PrologError
 from tqdm import tqdm
 
+from engine_pool import EnginePool
 from fen_to_contents import fen_to_contents
+from pgn_utils import BoardCollector
 
 BK_FILE = os.path.join('bk.pl')
 
@@ -21,6 +24,13 @@ LICHESS_2013 = os.path.join('data', 'lichess_db_standard_rated_2013-01.pgn')
 STOCKFISH = os.path.join('bin', 'stockfish_14_x64')
 MAIA_1100 = os.path.join(os.path.expanduser('~'), 'repos', 'lc0', 'build', 'release', 'lc0')
 
+MATE_SCORE = 2000 # centipawn value of a forced mate when comparing scores
+MAX_SUGGESTIONS = 3 # number of moves a tactic may suggest in a position
+DCG_WEIGHTS = 1 / np.log2(np.arange(MAX_SUGGESTIONS) + 2) # discount of the suggestion at each rank
+
+SQUARE_NAMES = chess.SQUARE_NAMES
+SQUARES_BY_NAME = {name: square for square, name in enumerate(chess.SQUARE_NAMES)}
+
 # TODO: brainstorm how to add this info in the bias file
 PRED_VALUE = {
     'make_move': 0,
@@ -31,70 +41,85 @@ PRED_VALUE = {
     'different_pos': 3,
     'other_side': 3
 }
+NUM_PRED_VALUES = max(PRED_VALUE.values()) + 1
 
-prolog = Prolog()
-prolog.consult(BK_FILE)
+_position_ids = {} # EPD -> id of the position's asserted position_moves fact
+_ranked_moves = {} # EPD -> engine's ranking of every legal move
 
 logger = logging.getLogger(__name__)
 logger.propagate = False # https://stackoverflow.com/a/2267567
 
-def games(pgn):
-    while game := chess.pgn.read_game(pgn):
-        yield game
-
-def get_evals(engine, board, suggestions):
-    evals = []
-    for move in suggestions:
-        analysis = engine.analyse(board, limit=chess.engine.Limit(depth=1), root_moves=[move])
-        if 'pv' in analysis: 
-            evals.append((analysis['score'].relative, analysis['pv'][0]))
-    return evals
-
-def evaluate(evaluated_suggestions, top_moves):
-    dcg = 0
-    for idx, (evaluated_move, top_move) in enumerate(zip(evaluated_suggestions, top_moves)):
-        score, move = evaluated_move
-        eval = score.score(mate_score=2000)
-        score_top, move_top = top_move
-        top_eval = score_top.score(mate_score=2000)
-        error = abs(top_eval - eval)
-        dcg += error / math.log2(1 + (idx + 1))
-    return dcg
-
-def evaluate_avg(evaluated_suggestions, top_moves):
-    total = 0
-    for idx, (evaluated_move, top_move) in enumerate(zip(evaluated_suggestions, top_moves)):
-        score, move = evaluated_move
-        eval = score.score(mate_score=2000)
-        score_top, move_top = top_move
-        top_eval = score_top.score(mate_score=2000)
-        total += abs(top_eval - eval)
-    return total / len(top_moves)
-
-def get_top_n_moves(engine, n, board):
-    analysis = engine.analyse(board, limit=chess.engine.Limit(depth=1), multipv=n)
-    top_n_moves = [(root['score'].relative, root['pv'][0]) for root in analysis]
-    return top_n_moves[:n]
-
-def tactic(text, board, limit=3, time_limit_sec=5):
-    "Given the text of a Prolog-based tactic, and a position, check whether the tactic matched in the given position or and if so, what were the suggested moves"
-    
-    position = fen_to_contents(board.fen())
-    
-    prolog.assertz(text)
-    # assert legal moves based on current position
-    for move in board.legal_moves:
-        from_sq = chess.square_name(move.from_square)
-        to_sq = chess.square_name(move.to_square)
-        legal_move_pred = f'legal_move({from_sq}, {to_sq}, {position})'
-        logger.debug(f'Legal move predicate: {legal_move_pred}')
-        prolog.assertz(legal_move_pred)
-
-    query = f"f({position}, From, To)"
-    logger.debug(f'Launching query: {query} with time limit: {time_limit_sec}s')
+@functools.lru_cache(maxsize=None)
+def get_prolog():
+    "Start Prolog with the background knowledge loaded, the first time it is needed in this process"
+    prolog = Prolog()
+    prolog.consult(BK_FILE)
+    return prolog
+
+def games(pgn, max_boards=None):
+    "Yield the mainline boards of each game in a PGN file, stopping after max_boards boards of each game"
+    visitor = functools.partial(BoardCollector, max_boards)
+    while (boards := chess.pgn.read_game(pgn, Visitor=visitor)) is not None:
+        yield boards
+
+def score_errors(analyses):
+    "Flatten (evals, top_n_moves) pairs of many positions into arrays of score errors, suggestion ranks and number of top moves"
+    evals, top_evals, ranks, num_top = [], [], [], []
+    for evaluated_suggestions, top_moves in analyses:
+        for idx, ((score, move), (score_top, move_top)) in enumerate(zip(evaluated_suggestions, top_moves)):
+            evals.append(score.score(mate_score=MATE_SCORE))
+            top_evals.append(score_top.score(mate_score=MATE_SCORE))
+            ranks.append(idx)
+            num_top.append(len(top_moves))
+    errors = np.abs(np.array(top_evals, dtype=np.int32) - np.array(evals, dtype=np.int32))
+    return errors, np.array(ranks, dtype=np.int32), np.array(num_top, dtype=np.int32)
+
+def evaluate(errors, ranks):
+    "Discounted cumulative error of suggestions against the engine moves of the same rank"
+    return float(errors @ DCG_WEIGHTS[ranks])
+
+def evaluate_avg(errors, num_top):
+    "Sum over positions of the mean error of suggestions against the engine's top moves"
+    return float((errors / num_top).sum())
+
+def prepare_position(board):
+    "Assert the contents and legal moves of a position once, to be shared by every tactic, and return the id of the fact"
+    key = board.epd()
+    position_id = _position_ids.get(key)
+    if position_id is None: # repeated positions share a single fact
+        position = fen_to_contents(board)
+        moves = [f'move({SQUARE_NAMES[move.from_square]},{SQUARE_NAMES[move.to_square]})' for move in board.legal_moves]
+        fact_args = f'{position},[{",".join(moves)}]'
+        position_id = _position_ids[key] = len(_position_ids)
+        logger.debug('Position %d: %s', position_id, fact_args)
+        get_prolog().assertz(f'position_moves({position_id},{fact_args})')
+    return board, position_id
+
+def load_positions(pgn, game_limit=10, pos_limit=10):
+    "Read up to pos_limit positions from each of the first game_limit games of a PGN file"
+    positions = [] # list of boards for each game
+    max_boards = pos_limit + 2 if pos_limit else None # start position, pos_limit positions and one more to tell if the last is final
+    for boards in games(pgn, max_boards):
+        positions.append(boards[1:-1]) # skip start and final positions
+        if game_limit and len(positions) >= game_limit:
+            break
+    return positions
+
+def setup_tactic(text):
+    "Assert the clause of a Prolog-based tactic so that it can be matched against many positions"
+    get_prolog().assertz(text)
+
+def retract_tactic(text):
+    get_prolog().retract(text)
+
+def tactic(text, position_id, limit=3, time_limit_sec=5):
+    "Given the text of an asserted Prolog-based tactic, and the id of a prepared position, check whether the tactic matched in the given position or and if so, what were the suggested moves"
+    query = f'suggestion({position_id}, From, To)'
+    # lazy formatting, since this runs for every position of every tactic
+    logger.debug('Launching query: %s with time limit: %ss', query, time_limit_sec)
     try:
-        results = list(prolog.query(f'call_with_time_limit({time_limit_sec}, {query})', maxresult=limit))
-        logger.debug(f'Results: {results}')
+        results = list(get_prolog().query(f'call_with_time_limit({time_limit_sec}, {query})', maxresult=limit))
+        logger.debug('Results: %s', results)
     except PrologError:
         logger.warning(f'timeout after {time_limit_sec}s on tactic {text}')
         return None, None
@@ -104,64 +129,110 @@ def tactic(text, board, limit=3, time_limit_sec=5):
         match = True
         # convert suggestions to chess.Moves
         def suggestion_to_move(suggestion):
-            from_sq = chess.parse_square(suggestion['From'])
-            to_sq = chess.parse_square(suggestion['To'])
+            from_sq = SQUARES_BY_NAME[suggestion['From']]
+            to_sq = SQUARES_BY_NAME[suggestion['To']]
             return chess.Move(from_sq, to_sq)
         suggestions = list(map(suggestion_to_move, results))
-    prolog.retract(text)
-    prolog.retractall('legal_move(_, _, _)')
     return match, suggestions
 
-def calc_metrics(tactic_text, engine, positions, game_limit=10, pos_limit=10):
+def get_ranked_moves(engine, board):
+    "Rank every legal move of a position with a single MultiPV search"
+    # only the score and PV are needed, so skip parsing the rest of each info line
+    analysis = engine.analyse(board, limit=chess.engine.Limit(depth=1), multipv=board.legal_moves.count(), info=chess.engine.INFO_SCORE | chess.engine.INFO_PV)
+    return [(root['score'].relative, root['pv'][0]) for root in analysis if 'pv' in root]
+
+def rank_positions(pool, positions):
+    "Rank the legal moves of every distinct position once, since the ranking is the same for every tactic"
+    boards = {board.epd(): board for game_boards in positions for board in game_boards}
+    ranked_moves = pool.imap(lambda board: get_ranked_moves(pool, board), boards.values())
+    return dict(zip(boards, tqdm(ranked_moves, total=len(boards), desc='Ranking positions', unit='positions')))
+
+def get_evals_and_top_n_moves(board, suggestions):
+    "Score the suggested moves and find the engine's top len(suggestions) moves from the precomputed ranking of every legal move"
+    ranked_moves = _ranked_moves[board.epd()]
+    scores = {move: score for score, move in ranked_moves}
+    evals = [(scores[move], move) for move in suggestions if move in scores]
+    return evals, ranked_moves[:len(suggestions)]
+
+def calc_metrics(tactic_text, positions):
     total_games = 0  # total number of games
     total_positions = 0 # total number of positions (across all games)
     total_matches = 0
-    dcg = 0
-    avg = 0
     empty_suggestions = 0
+    timed_out = False
 
-    for game in tqdm(games(positions), total=game_limit * pos_limit, desc='Positions', unit='positions', leave=False):
-        curr_positions = 0
-        node = game.next() # skip start position
-        while not node.is_end():
-            board = node.board()
-            match, suggestions = tactic(tactic_text, board, limit=3)
-            if match is None:
-                return
-            if match:
-                total_matches += 1
-                if suggestions:
-                    evals = get_evals(engine, board, suggestions)
-                    top_n_moves = get_top_n_moves(engine, len(suggestions), board)
-                    dcg += evaluate(evals, top_n_moves)
-                    avg += evaluate_avg(evals, top_n_moves)
-                else:
-                    empty_suggestions += 1
-            curr_positions += 1
-            total_positions += 1
-            if pos_limit and curr_positions >= pos_limit:
-                break
-            node = node.next()
-        total_games += 1
-        if game_limit and total_games >= game_limit:
-            break
-    
-    if total_matches > 0:
-        logger.info(f'Tactic: {tactic_text}')
-        logger.info(f'# of games: {total_games}')
-        logger.info(f'# of positions: {total_positions}')
-        logger.info(f'Coverage: {total_matches / total_positions * 100:.2f}%') # % of matched positions
-        logger.info(f'# of empty suggestions: {empty_suggestions}/{total_positions}') # number of positions where tactic did not suggest any move
-        logger.info(f'DCG = {dcg:.2f}')
-        logger.info(f'Average = {avg:.2f}')
-    else:
-        logger.debug(f'Tactic: {tactic_text}')
-        logger.debug(f'# of games: {total_games}')
-        logger.debug(f'# of positions: {total_positions}')
-        logger.debug(f'Coverage: {total_matches / total_positions * 100:.2f}%') # % of matched positions
-        logger.debug(f'# of empty suggestions: {empty_suggestions}/{total_positions}') # number of positions where tactic did not suggest any move
-        logger.debug(f'DCG = {dcg:.2f}')
-        logger.debug(f'Average = {avg:.2f}')
+    def matches():
+        "Yield the (board, suggestions) pairs of the positions the tactic matched in, tallying the totals as it goes"
+        nonlocal total_games, total_positions, total_matches, empty_suggestions, timed_out
+        results = {} # position id -> (match, suggestions), for positions repeated across games
+        setup_tactic(tactic_text)
+        try:
+            for game_positions in positions:
+                for board, position_id in game_positions:
+                    if position_id not in results:
+                        results[position_id] = tactic(tactic_text, position_id, limit=MAX_SUGGESTIONS)
+                    match, suggestions = results[position_id]
+                    if match is None: # a timeout ends the tactic, so it is never reused
+                        timed_out = True
+                        return
+                    if match:
+                        total_matches += 1
+                        if suggestions:
+                            yield board, suggestions
+                        else:
+                            empty_suggestions += 1
+                    total_positions += 1
+                total_games += 1
+        finally:
+            retract_tactic(tactic_text)
+
+    analyses = (get_evals_and_top_n_moves(board, suggestions) for board, suggestions in matches())
+    errors, ranks, num_top = score_errors(analyses)
+    if timed_out:
+        return None
+    return {
+        'tactic_text': tactic_text,
+        'total_games': total_games,
+        'total_positions': total_positions,
+        'total_matches': total_matches,
+        'empty_suggestions': empty_suggestions,
+        'dcg': evaluate(errors, ranks),
+        'avg': evaluate_avg(errors, num_top),
+    }
+
+def log_metrics(metrics):
+    "Log the metrics of a tactic, at INFO level if it matched any position and DEBUG level otherwise"
+    log = logger.info if metrics['total_matches'] > 0 else logger.debug
+    total_positions = metrics['total_positions']
+    log(f'Tactic: {metrics["tactic_text"]}')
+    log(f'# of games: {metrics["total_games"]}')
+    log(f'# of positions: {total_positions}')
+    log(f'Coverage: {metrics["total_matches"] / total_positions * 100:.2f}%') # % of matched positions
+    log(f'# of empty suggestions: {metrics["empty_suggestions"]}/{total_positions}') # number of positions where tactic did not suggest any move
+    log(f'DCG = {metrics["dcg"]:.2f}')
+    log(f'Average = {metrics["avg"]:.2f}')
+
+def setup_logging(log_level):
+    logging.basicConfig(level=getattr(logging, log_level))
+    fmt = logging.Formatter('[%(levelname)s] [%(asctime)s] %(funcName)s:%(lineno)d - %(message)s')
+    hdlr = logging.FileHandler('info.log', encoding='utf-8')
+    hdlr.setFormatter(fmt)
+    hdlr.setLevel(logging.DEBUG)
+    logger.addHandler(hdlr)
+
+worker_positions = None # prepared positions of a tactic worker process, set up by init_worker
+
+def init_worker(boards, ranked_moves, log_level):
+    "Set up a tactic worker process with the positions asserted into its own Prolog engine and their engine rankings"
+    global worker_positions
+    setup_logging(log_level)
+    worker_positions = [[prepare_position(board) for board in game_boards] for game_boards in boards]
+    _ranked_moves.update(ranked_moves)
+
+def run_tactic(tactic_text):
+    "Calculate the metrics of a tactic in a worker process"
+    logger.debug(tactic_text)
+    return calc_metrics(tactic_text, worker_positions)
 
 def pred2str(predicate):
     "Converts a parsed predicate into its string representation"
@@ -170,9 +241,11 @@ def pred2str(predicate):
 def parse_result_to_str(parse_result):
     "Converts a parsed hypothesis space into a list of tactics represented by strings"
     head_pred_str = pred2str(parse_result[0])
-    body_preds = parse_result[1:]
-    body_preds.sort(key=lambda pred: PRED_VALUE[pred.id])
-    body_preds_str = ','.join([pred2str(pred) for pred in body_preds])
+    # stable bucket sort on the few distinct predicate values, cheapest predicates first
+    buckets = [[] for _ in range(NUM_PRED_VALUES)]
+    for pred in parse_result[1:]:
+        buckets[PRED_VALUE[pred.id]].append(pred)
+    body_preds_str = ','.join([pred2str(pred) for bucket in buckets for pred in bucket])
     tactic_str = f'{head_pred_str}:-{body_preds_str}'
     logger.debug(f'Tactic str: {tactic_str}')
     return tactic_str
@@ -184,15 +257,11 @@ def main():
     parser.add_argument('-n', '--num_tactics', dest='tactics_limit', type=int, help='Number of tactics to analyze', default=100)
     parser.add_argument('-e', '--engine', dest='engine_path', default=STOCKFISH, help='Path to engine executable to use for calculating divergence')
     parser.add_argument('-p', '--position_db', dest='position_db', default=LICHESS_2013, help='Path to PGN file of positions to use for calculating divergence')
+    parser.add_argument('-j', '--jobs', dest='jobs', type=int, default=os.cpu_count(), help='Number of worker processes to match tactics in, each with its own Prolog engine')
+    parser.add_argument('-w', '--workers', dest='workers', type=int, default=os.cpu_count(), help='Number of single-threaded engine processes to analyse positions with')
     args = parser.parse_args()
 
-    logging.basicConfig(level=getattr(logging, args.log_level))
-    logger = logging.getLogger(__name__)
-    fmt = logging.Formatter('[%(levelname)s] [%(asctime)s] %(funcName)s:%(lineno)d - %(message)s')
-    hdlr = logging.FileHandler('info.log', encoding='utf-8')
-    hdlr.setFormatter(fmt)
-    hdlr.setLevel(logging.DEBUG)
-    logger.addHandler(hdlr)
+    setup_logging(args.log_level)
 
     hspace_filename = args.tactics_file
     tactics_limit = args.tactics_limit
@@ -202,19 +271,21 @@ def main():
     tactics = parse_file(hspace_filename)
     tactics = sorted(tactics, key=lambda ele: len(ele) - 1)
     tactics = list(map(parse_result_to_str, tactics))
-    engine = chess.engine.SimpleEngine.popen_uci(engine_path)
-    
-    for tactic in tqdm(tactics[:tactics_limit], desc='Tactics', unit='tactics'):
-        tactic_text = tactic
-        logger.debug(tactic_text)
-        try:
-            calc_metrics(tactic_text, engine, open(position_db), game_limit=10, pos_limit=10)
-        except chess.engine.EngineTerminatedError:
-            engine = chess.engine.SimpleEngine.popen_uci(engine_path)
-            # TODO: how to handle engine failure on a tactic? Need to restart it
-            tactics.append(tactic_text)
-            continue
-    engine.close()
+    with open(position_db) as pgn:
+        boards = load_positions(pgn, game_limit=10, pos_limit=10)
+    with EnginePool(engine_path, args.workers) as pool:
+        ranked_moves = rank_positions(pool, boards)
+
+    # SWI-Prolog is a per-process singleton, so tactics are spread over worker processes which each
+    # start their own Prolog. Workers are spawned rather than forked so that they do not inherit the
+    # state of the SWI-Prolog library loaded by this process.
+    initargs = (boards, ranked_moves, args.log_level)
+    with ProcessPoolExecutor(max_workers=args.jobs, mp_context=multiprocessing.get_context('spawn'), initializer=init_worker, initargs=initargs) as executor, \
+         tqdm(total=min(tactics_limit, len(tactics)), desc='Tactics', unit='tactics') as progress:
+        for metrics in executor.map(run_tactic, tactics[:tactics_limit]):
+            if metrics is not None:
+                log_metrics(metrics)
+            progress.update()
 
 if __name__ == '__main__':
     main()
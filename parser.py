@@ -1,38 +1,90 @@
-# Source: https://stackoverflow.com/a/24490005
-
-import pyparsing as pp
-
-def create_parser():
-    predicate = pp.Word(pp.alphas + '_').set_results_name('id')
-
-    number = pp.Word(pp.nums + '.').set_parse_action(lambda s, l, t: [int(t[0])])
-    variable = pp.Word(pp.alphas + '_')
-
-    # an argument to a fact can be either a number or a variable
-    simple_arg = number | variable
-
-    # arguments are a delimited list of 'argument' surrounded by parenthesis
-    simple_arg_list = pp.Group(pp.Suppress('(') + pp.delimited_list(simple_arg, delim=',') +
-                               pp.Suppress(')'))
-    
-    arg = simple_arg | simple_arg_list
-
-    arguments = (pp.Suppress('(') + pp.delimited_list(arg, delim=',') + 
-                 pp.Suppress(')')).set_results_name('args')
-
-    fact = (predicate + arguments)
-
-    comment = pp.Literal('%') + pp.Word(pp.alphanums + '_' + ' ' + ',' + ':')
-
-    rule = (pp.Group(fact) + pp.Suppress(pp.Literal(':-')) + pp.delimited_list(pp.Group(fact), delim=',') + pp.Suppress('.'))
-
-    prolog_parser = pp.OneOrMore(pp.Group(rule)).ignore(comment)
-    return prolog_parser
-
-prolog = create_parser()
+import re
+from types import SimpleNamespace
+
+# whitespace and % comments are matched but not captured, everything else is a token
+TOKEN_RE = re.compile(r'\s+|%[^\n]*|(?P<token>:-|\d+(?:\.\d+)?|[A-Za-z_]\w*|[(),.])')
+
+class ParseError(ValueError):
+    pass
+
+def tokenize(text):
+    "Split Prolog source into a list of tokens, skipping whitespace and comments"
+    tokens = []
+    pos = 0
+    while pos < len(text):
+        match = TOKEN_RE.match(text, pos)
+        if match is None:
+            raise ParseError(f'Unexpected character {text[pos]!r} at offset {pos}')
+        if match.group('token'):
+            tokens.append(match.group('token'))
+        pos = match.end()
+    return tokens
+
+def expect(tokens, idx, token):
+    if idx >= len(tokens) or tokens[idx] != token:
+        found = tokens[idx] if idx < len(tokens) else 'end of input'
+        raise ParseError(f'Expected {token!r} but found {found!r}')
+    return idx + 1
+
+def parse_simple_arg(tokens, idx):
+    "Parse a number or a variable/atom"
+    if idx >= len(tokens) or not (tokens[idx][0].isalnum() or tokens[idx][0] == '_'):
+        found = tokens[idx] if idx < len(tokens) else 'end of input'
+        raise ParseError(f'Expected an argument but found {found!r}')
+    token = tokens[idx]
+    if token[0].isdigit():
+        return (float(token) if '.' in token else int(token)), idx + 1
+    return token, idx + 1
+
+def parse_arg_list(tokens, idx, parse_arg):
+    "Parse a parenthesised, comma-delimited list of arguments"
+    idx = expect(tokens, idx, '(')
+    args = []
+    while True:
+        arg, idx = parse_arg(tokens, idx)
+        args.append(arg)
+        if idx < len(tokens) and tokens[idx] == ',':
+            idx += 1
+        else:
+            break
+    idx = expect(tokens, idx, ')')
+    return args, idx
+
+def parse_arg(tokens, idx):
+    "Parse an argument, which is either a simple argument or a parenthesised list of them"
+    if idx < len(tokens) and tokens[idx] == '(':
+        return parse_arg_list(tokens, idx, parse_simple_arg)
+    return parse_simple_arg(tokens, idx)
+
+def parse_predicate(tokens, idx):
+    name, idx = parse_simple_arg(tokens, idx)
+    args, idx = parse_arg_list(tokens, idx, parse_arg)
+    return SimpleNamespace(id=name, args=args), idx
+
+def parse_string(text):
+    "Parse Prolog clauses into a list of [head, *body] predicate lists, each predicate having an id and args"
+    tokens = tokenize(text)
+    result = []
+    idx = 0
+    while idx < len(tokens):
+        predicate, idx = parse_predicate(tokens, idx)
+        clause = [predicate]
+        if idx < len(tokens) and tokens[idx] == ':-':
+            idx += 1
+            while True:
+                predicate, idx = parse_predicate(tokens, idx)
+                clause.append(predicate)
+                if idx < len(tokens) and tokens[idx] == ',':
+                    idx += 1
+                else:
+                    break
+        idx = expect(tokens, idx, '.')
+        result.append(clause)
+    return result
 
 def parse_file(filename):
-    result = prolog.parse_file(filename, parse_all=True)
+    with open(filename) as f:
+        result = parse_string(f.read())
     return result
 
 def to_pred_str(predicate):
@@ -45,28 +97,26 @@ def get_pred_str_list(results):
     return [to_pred_str(predicate) for predicate in results]
 
 def get_all_unique_args(results):
-    res = []
+    res = set()
     for predicate in results:
-        res.extend(predicate.args)
-    return list(set(res))
+        res.update(predicate.args)
+    return list(res)
 
 if __name__ == '__main__':
-    prolog_sentences = create_parser()
-
     test="""track(1, 2.0, 4000, 3, 300).
     track(2, 1.0, 9000, 5, 500).
     track(3, 7.0, 9000, 2, 200)."""
 
-    result = prolog_sentences.parse_string(test, parse_all=True)
+    result = parse_string(test)
 
-    print(result[0].args)
-    # outputs ['1', '2.0', '4000', '3', '300']
+    print(result[0][0].args)
+    # outputs [1, 2.0, 4000, 3, 300]
 
-    print(result[1].id)
+    print(result[1][0].id)
     # outputs 'track'
 
-    print(result[2].args[1])
-    # outputs ['7.0']
+    print(result[2][0].args[1])
+    # outputs 7.0
 
-    result = parse_file('examples/even/pos.pl')
-    print(result.dump())
\ No newline at end of file
+    result = parse_file('bias.pl')
+    print(result)
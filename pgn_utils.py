@@ -0,0 +1,47 @@
+import logging
+from typing import List, Optional
+
+import chess
+import chess.pgn
+
+logger = logging.getLogger(__name__)
+
+class BoardsFull(ValueError):
+    "Raised instead of parsing a move once a BoardCollector has all the boards it needs"
+
+class BoardCollector(chess.pgn.BaseVisitor):
+    "Collects a copy of the board at each ply of the mainline, up to max_boards boards, without building the game tree"
+
+    def __init__(self, max_boards: Optional[int]=None):
+        self.max_boards = max_boards
+
+    def is_full(self) -> bool:
+        return self.stopped or (self.max_boards is not None and len(self.boards) >= self.max_boards)
+
+    def begin_game(self):
+        self.boards = []
+        self.stopped = False # set on a parse error, keeping the boards up to it
+
+    def begin_variation(self):
+        return chess.pgn.SKIP
+
+    def parse_san(self, board: chess.Board, san: str) -> chess.Move:
+        # once full, fail the move so that the reader skips the rest of the movetext without parsing
+        # or replaying it (chess 1.6 has no begin_parse_san hook to skip it with)
+        if self.is_full():
+            raise BoardsFull(san)
+        return board.parse_san(san)
+
+    def visit_board(self, board: chess.Board):
+        if not self.is_full():
+            self.boards.append(board.copy()) # keep the move stack so that engines can see repetitions
+
+    def handle_error(self, error: Exception):
+        # like GameBuilder, log errors and carry on with the boards read so far, the reader then skips
+        # the rest of the game
+        if not isinstance(error, BoardsFull):
+            logger.error('%s while parsing game, keeping its first %d boards', error, len(self.boards))
+            self.stopped = True
+
+    def result(self) -> List[chess.Board]:
+        return self.boards